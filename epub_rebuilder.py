@@ -1,14 +1,20 @@
 #!/usr/bin/env python3
+import io
+import itertools
 import os
+import posixpath
 import re
 import shutil
 import zipfile
 import xml.etree.ElementTree as ET
+import xml.sax
 import argparse
+from xml.sax.saxutils import escape, quoteattr
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from bs4 import BeautifulSoup
-from ebooklib import epub
-from pathlib import Path
-from uuid import uuid4
+from lxml import etree
+from lxml import html as lhtml
 
 # Register namespaces for XML parsing
 ET.register_namespace('', 'http://www.idpf.org/2007/opf')
@@ -16,96 +22,107 @@ ET.register_namespace('dc', 'http://purl.org/dc/elements/1.1/')
 ET.register_namespace('opf', 'http://www.idpf.org/2007/opf')
 ET.register_namespace('epub', 'http://www.idpf.org/2007/ops')
 
-def extract_epub(epub_path, extract_dir):
-    """Extract EPUB file to a directory"""
-    print(f"Extracting {epub_path} to {extract_dir}")
-    
-    # Create extract directory if it doesn't exist
-    os.makedirs(extract_dir, exist_ok=True)
-    
-    # Extract the EPUB (which is just a ZIP file)
-    with zipfile.ZipFile(epub_path, 'r') as zip_ref:
-        zip_ref.extractall(extract_dir)
-    
-    print("Extraction complete")
+# File-classification constants, hoisted so the hot loops don't rebuild them
+_NAV_COVER_RE = re.compile(r'(?:nav|cover)\.xhtml', re.I)  # hrefs to skip when splitting
+_SKIP_IDS = frozenset({'nav', 'ncx'})       # manifest/spine ids never removed
+_KEEP_SPINE_IDS = frozenset({'nav', 'cover'})  # spine docs kept as-is
+_CHAPTER_ID_PREFIX = 'ch_'
 
-def find_content_opf(extract_dir):
-    """Find the content.opf file in the extracted EPUB"""
-    container_path = os.path.join(extract_dir, 'META-INF', 'container.xml')
-    
-    if not os.path.exists(container_path):
-        raise FileNotFoundError(f"Could not find container.xml at {container_path}")
-    
-    # Parse container.xml to find content.opf
-    tree = ET.parse(container_path)
-    root = tree.getroot()
-    
-    # Find the rootfile element with media-type="application/oebps-package+xml"
-    ns = {'ns': 'urn:oasis:names:tc:opendocument:xmlns:container'}
-    rootfile_element = root.find('.//ns:rootfile[@media-type="application/oebps-package+xml"]', ns)
-    
-    if rootfile_element is None:
-        # Try without namespace
-        rootfile_element = root.find('.//rootfile[@media-type="application/oebps-package+xml"]')
-    
-    if rootfile_element is None:
-        raise ValueError("Could not find content.opf reference in container.xml")
-    
-    content_opf_path = rootfile_element.get('full-path')
-    return os.path.join(extract_dir, content_opf_path)
+class _RootfileFound(Exception):
+    """Raised by _ContainerHandler to short-circuit the SAX parse"""
+
+    def __init__(self, full_path):
+        self.full_path = full_path
+
+class _ContainerHandler(xml.sax.ContentHandler):
+    """Pulls the first matching rootfile/@full-path and stops parsing"""
+
+    def startElement(self, name, attrs):
+        # Tag may or may not carry a namespace prefix
+        if (name.rsplit(':', 1)[-1] == 'rootfile' and
+                attrs.get('media-type') == 'application/oebps-package+xml'):
+            raise _RootfileFound(attrs.get('full-path'))
+
+def find_content_opf(zf):
+    """Find the content.opf path inside the EPUB zip"""
+    try:
+        container_data = zf.read('META-INF/container.xml')
+    except KeyError:
+        raise FileNotFoundError("Could not find META-INF/container.xml in EPUB")
+
+    # Stream container.xml through SAX; the handler raises as soon as the
+    # rootfile element appears, so only the first few tags are ever read —
+    # no tree is built for a file we need one attribute from.
+    try:
+        xml.sax.parseString(container_data, _ContainerHandler())
+    except _RootfileFound as found:
+        return found.full_path
 
-def parse_content_opf(content_opf_path):
+    raise ValueError("Could not find content.opf reference in container.xml")
+
+def parse_content_opf(zf, opf_name):
     """Parse content.opf to get metadata, manifest, and spine"""
-    tree = ET.parse(content_opf_path)
-    root = tree.getroot()
-    
-    # Directory containing content.opf
-    opf_dir = os.path.dirname(content_opf_path)
-    
-    # Parse manifest to get all items
+    # Directory containing content.opf (inside the zip, so posix paths)
+    opf_dir = posixpath.dirname(opf_name)
+
+    # Single iterparse pass: manifest items and spine itemrefs are collected
+    # as their events arrive instead of re-walking the finished tree with
+    # './/' queries.  The manifest/spine element references are kept so the
+    # rewrite in update_content_opf doesn't have to search for them again.
+    root = None
+    manifest_elem = None
+    spine_elem = None
     manifest = {}
-    manifest_elem = root.find('.//{http://www.idpf.org/2007/opf}manifest')
-    
-    if manifest_elem is None:
-        manifest_elem = root.find('.//manifest')
-    
+    by_href = {}
+    by_media_type = defaultdict(list)
+    spine_idrefs = []
+
+    for event, elem in ET.iterparse(io.BytesIO(zf.read(opf_name)), events=('start', 'end')):
+        tag = elem.tag.rsplit('}', 1)[-1]
+        if event == 'start':
+            if root is None:
+                root = elem
+            elif tag == 'manifest':
+                manifest_elem = elem
+            elif tag == 'spine':
+                spine_elem = elem
+        elif tag == 'item':
+            entry = {
+                'id': elem.get('id'),
+                'href': elem.get('href'),
+                'media-type': elem.get('media-type'),
+                'full_path': posixpath.join(opf_dir, elem.get('href'))
+            }
+            manifest[entry['id']] = entry
+            # Secondary indexes so callers don't have to scan the manifest
+            by_href.setdefault(entry['href'], entry)
+            by_media_type[entry['media-type']].append(entry)
+        elif tag == 'itemref':
+            spine_idrefs.append(elem.get('idref'))
+
     if manifest_elem is None:
         raise ValueError("Could not find manifest in content.opf")
-    
-    for item in manifest_elem:
-        item_id = item.get('id')
-        item_href = item.get('href')
-        item_media_type = item.get('media-type')
-        manifest[item_id] = {
-            'href': item_href,
-            'media-type': item_media_type,
-            'full_path': os.path.join(opf_dir, item_href)
-        }
-    
-    # Parse spine to get reading order
-    spine = []
-    spine_elem = root.find('.//{http://www.idpf.org/2007/opf}spine')
-    
-    if spine_elem is None:
-        spine_elem = root.find('.//spine')
-    
+
     if spine_elem is None:
         raise ValueError("Could not find spine in content.opf")
-    
-    for itemref in spine_elem:
-        idref = itemref.get('idref')
-        if idref in manifest:
-            spine.append(idref)
-    
+
+    # Reading order: spine itemrefs that actually exist in the manifest
+    spine = [idref for idref in spine_idrefs if idref in manifest]
+
     return {
-        'tree': tree,
+        'tree': ET.ElementTree(root),
         'root': root,
         'manifest': manifest,
+        'manifest_elem': manifest_elem,
+        'by_href': by_href,
+        'by_media_type': by_media_type,
         'spine': spine,
-        'opf_dir': opf_dir
+        'spine_elem': spine_elem,
+        'opf_dir': opf_dir,
+        'opf_name': opf_name
     }
 
-def find_chapter_boundaries(content_data):
+def find_chapter_boundaries(zf, content_data):
     """Identify chapters by splitting content on successive <h1> tags.
 
     The previous implementation grabbed the *entire* parent element of each
@@ -130,198 +147,195 @@ def find_chapter_boundaries(content_data):
             continue
 
         # Exclude navigation/cover documents explicitly
-        href_lower = item['href'].lower()
-        if any(token in href_lower for token in ("nav.xhtml", "cover.xhtml")):
+        if _NAV_COVER_RE.search(item['href']):
             continue
 
         content_files.append(item)
 
-    from bs4.element import Tag  # local import keeps top-level imports untouched
-
     # We walk through the spine in order, allowing chapters to span multiple
     # files.  `current_chapter_*` hold the chapter we are presently building.
+    # Chapters carry the raw lxml nodes between h1 boundaries; they are never
+    # serialized here — create_chapter_files moves them straight into the
+    # output documents, so there is no serialize/re-parse round trip at all.
 
     current_title: str | None = None
-    current_content: list[str] = []
+    current_nodes: list = []
+
+    def _flush_chapter():
+        chapters.append({
+            "title": current_title,
+            "content_nodes": current_nodes,
+            "id": f"ch_{len(chapters)}",
+        })
+
+    # Parse every spine document up front in a thread pool.  libxml2 releases
+    # the GIL during the parse, so this scales with core count; the h1
+    # boundary state machine below stays sequential over the parsed trees.
+    def _load(item):
+        return lhtml.fromstring(zf.read(item["full_path"]))
 
-    for item in content_files:
-        with open(item["full_path"], "r", encoding="utf-8") as f:
-            html_content = f.read()
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        docs = list(pool.map(_load, content_files))
 
-        soup = BeautifulSoup(html_content, "html.parser")
-        body = soup.body if soup.body else soup  # Fallback if <body> missing
+    for doc in docs:
+        body = doc.find("body")
+        if body is None:
+            body = doc  # Fallback if <body> missing
 
-        # Enumerate <h1> tags *in order* within this file.
-        h1_tags = list(body.find_all("h1"))
+        # Enumerate <h1> tags *in order* within this file.  iter() is a lazy
+        # C-level traversal — nothing is materialized up front; we only pull
+        # the first heading to know which branch we're in.
+        h1_iter = body.iter("h1")
+        first_h1 = next(h1_iter, None)
 
-        if not h1_tags:
+        if first_h1 is None:
             # No headings in this file; if we're inside a chapter, append the
-            # whole body markup to it and continue.
+            # whole body to it and continue.  Leading text of the body hangs
+            # off the previous node's tail so it survives serialization.
             if current_title is not None:
-                current_content.append(body.decode_contents())
+                if body.text:
+                    current_nodes[-1].tail = (current_nodes[-1].tail or "") + body.text
+                current_nodes.extend(body)
             continue
 
         # There are one or more <h1> tags in this file.
         # We iterate over them, each time finalising the previous chapter (if
         # any) and starting a new one.
-
-        # Use an iterator over the tag list so we can look at siblings for the
-        # content slice.
-        for idx, h1 in enumerate(h1_tags):
+        for h1 in itertools.chain((first_h1,), h1_iter):
             # Whenever we encounter a heading, we first finish the *previous*
             # chapter (if one exists and we have accumulated content).
             if current_title is not None:
-                chapters.append({
-                    "title": current_title,
-                    "content": "".join(current_content),
-                    "id": f"ch_{len(chapters)}",
-                })
+                _flush_chapter()
 
-            # Start the new chapter.
-            current_title = h1.get_text(strip=True)
-            current_content = [str(h1)]  # include the heading itself
+            # Start the new chapter.  tostring includes the element's tail,
+            # so the text between sibling nodes is carried along for free.
+            current_title = h1.text_content().strip()
+            current_nodes = [h1]
 
             # Gather nodes until the next h1 *within this file*.
-            for sibling in h1.next_siblings:
-                if isinstance(sibling, Tag) and sibling.name == "h1":
+            for sibling in h1.itersiblings():
+                if sibling.tag == "h1":
                     break
-                current_content.append(str(sibling))
+                current_nodes.append(sibling)
 
         # End for h1 in file – if there were multiple headings we have already
         # closed all but the last. The last one remains open (current_* vars).
 
     # After processing all content files, flush the final chapter if pending.
     if current_title is not None:
-        chapters.append({
-            "title": current_title,
-            "content": "".join(current_content),
-            "id": f"ch_{len(chapters)}",
-        })
+        _flush_chapter()
 
     return chapters
 
-def create_chapter_files(chapters, content_data):
-    """Create new XHTML files for each chapter"""
+def create_chapter_files(chapters, content_data, zf, new_files, removed_files):
+    """Create new XHTML documents for each chapter
+
+    The serialized documents land in `new_files` (arcname -> bytes); old
+    spine files that the chapters replace are recorded in `removed_files`
+    so the rebuild drops them.  Nothing touches the filesystem.
+    """
     chapter_files = []
-    
+
     # Get a template from an existing content file
     template_id = content_data['spine'][0]
     template_item = content_data['manifest'].get(template_id)
-    template_path = template_item['full_path']
-    
-    with open(template_path, 'r', encoding='utf-8') as file:
-        template_content = file.read()
-    
+
     # Parse template to extract <head> content
-    soup = BeautifulSoup(template_content, 'html.parser')
-    head = soup.head
-    
-    # First, remove all old content files except cover and nav
+    template_doc = lhtml.fromstring(zf.read(template_item['full_path']))
+    head = template_doc.find('head')
+
+    # First, drop all old content files except cover and nav
     for item_id in list(content_data['spine']):
         item = content_data['manifest'].get(item_id)
         if item and item['media-type'] == 'application/xhtml+xml':
-            if item['href'] != 'cover.xhtml' and item_id not in ('nav', 'cover') and not item_id.startswith('ch_'):
-                file_path = item['full_path']
-                if os.path.exists(file_path):
-                    try:
-                        os.remove(file_path)
-                        print(f"Removed old file: {file_path}")
-                    except Exception as e:
-                        print(f"Warning: Could not remove file {file_path}: {e}")
-    
-    # Create a new file for each chapter
+            if item['href'] != 'cover.xhtml' and item_id not in _KEEP_SPINE_IDS and not item_id.startswith(_CHAPTER_ID_PREFIX):
+                removed_files.add(item['full_path'])
+                print(f"Dropping old file: {item['full_path']}")
+
+    # Serialize the shared parts of every chapter document exactly once;
+    # assembling a chapter below is then pure byte concatenation plus one
+    # tostring per content node.
+    doc_open = (b"<?xml version='1.0' encoding='utf-8'?>\n"
+                b'<!DOCTYPE html>\n'
+                b'<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">')
+    body_open = b'<body><section epub:type="bodymatter chapter">'
+    doc_close = b'</section></body></html>'
+
+    if head is not None:
+        head_open = etree.tostring(head, encoding='utf-8', with_tail=False)
+        head_close = b''
+    else:
+        # Minimal head; the chapter title is the only piece that varies.
+        # Add a CSS link if available (O(1) via the media-type index).
+        css_items = content_data['by_media_type']['text/css']
+        css_link = (f'<link href={quoteattr(css_items[0]["href"])} rel="stylesheet" type="text/css" />'
+                    if css_items else '')
+        head_open = b'<head><title>'
+        head_close = b'</title>' + css_link.encode('utf-8') + b'</head>'
+
+    # Create a new document for each chapter
     for chapter in chapters:
         chapter_filename = f"{chapter['id']}.xhtml"
-        chapter_path = os.path.join(content_data['opf_dir'], chapter_filename)
-        
-        # Create a new HTML document
-        chapter_soup = BeautifulSoup('<!DOCTYPE html><html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops"></html>', 'html.parser')
-        
-        # Add head from template
-        if head:
-            chapter_soup.html.append(head)
+        chapter_arcname = posixpath.join(content_data['opf_dir'], chapter_filename)
+
+        if head is not None:
+            head_bytes = head_open
         else:
-            # Create a minimal head if none exists
-            new_head = chapter_soup.new_tag('head')
-            title_tag = chapter_soup.new_tag('title')
-            title_tag.string = chapter['title']
-            new_head.append(title_tag)
-            
-            # Add CSS link if available
-            css_href = None
-            for item in content_data['manifest'].values():
-                if item['media-type'] == 'text/css':
-                    css_href = item['href']
-                    break
-            
-            if css_href:
-                link_tag = chapter_soup.new_tag('link')
-                link_tag['href'] = css_href
-                link_tag['rel'] = 'stylesheet'
-                link_tag['type'] = 'text/css'
-                new_head.append(link_tag)
-            
-            chapter_soup.html.append(new_head)
-        
-        # Create body
-        body = chapter_soup.new_tag('body')
-        section = chapter_soup.new_tag('section', attrs={'epub:type': 'bodymatter chapter'})
-        
-        # Parse and add chapter content
-        content_soup = BeautifulSoup(chapter['content'], 'html.parser')
-        section.append(content_soup)
-        
-        body.append(section)
-        chapter_soup.html.append(body)
-        
-        # Write the chapter file
-        with open(chapter_path, 'w', encoding='utf-8') as file:
-            file.write(str(chapter_soup))
-        
+            head_bytes = head_open + escape(chapter['title']).encode('utf-8') + head_close
+
+        # One C-level serialization per node; tostring carries the tail text
+        content = b''.join(
+            etree.tostring(node, encoding='utf-8')
+            for node in chapter['content_nodes']
+        )
+
+        new_files[chapter_arcname] = doc_open + head_bytes + body_open + content + doc_close
+
         # Add to chapter files list
         chapter_files.append({
             'id': chapter['id'],
             'href': chapter_filename,
             'title': chapter['title'],
-            'path': chapter_path
+            'path': chapter_arcname
         })
-    
+
     return chapter_files
 
-def update_content_opf(content_data, chapter_files):
+def update_content_opf(content_data, chapter_files, new_files):
     """Update content.opf with new chapter files"""
-    root = content_data['root']
     tree = content_data['tree']
-    
-    # Update manifest
-    manifest_elem = root.find('.//{http://www.idpf.org/2007/opf}manifest')
-    if manifest_elem is None:
-        manifest_elem = root.find('.//manifest')
-    
+
+    # Update manifest (element reference cached by parse_content_opf)
+    manifest_elem = content_data['manifest_elem']
+
     # Remove old content items from manifest
     content_items_to_remove = []
     for item in manifest_elem:
         item_id = item.get('id')
         href = item.get('href')
         # Skip nav, ncx, and cover.xhtml; remove other XHTML that are not new chapters
-        if (item_id not in ['nav', 'ncx'] and
+        if (item_id not in _SKIP_IDS and
             href != 'cover.xhtml' and
             item.get('media-type') == 'application/xhtml+xml' and
-            not item_id.startswith('ch_')):
+            not item_id.startswith(_CHAPTER_ID_PREFIX)):
             content_items_to_remove.append(item)
     
     for item in content_items_to_remove:
         manifest_elem.remove(item)
-    
+
+    # Index the surviving manifest items once so the chapter loop below is
+    # an O(1) lookup instead of a linear scan per chapter
+    existing_manifest = {item.get('id'): item for item in manifest_elem}
+
+    # Idrefs that point at cover.xhtml, precomputed for the spine loops
+    cover_idrefs = {item_id for item_id, m in content_data['manifest'].items()
+                    if m['href'] == 'cover.xhtml'}
+
     # Add new chapter items
     for chapter in chapter_files:
         # Check if item already exists
-        existing_item = None
-        for item in manifest_elem:
-            if item.get('id') == chapter['id']:
-                existing_item = item
-                break
-        
+        existing_item = existing_manifest.get(chapter['id'])
+
         if existing_item is not None:
             # Update existing item
             existing_item.set('href', chapter['href'])
@@ -333,23 +347,17 @@ def update_content_opf(content_data, chapter_files):
             item.set('href', chapter['href'])
             item.set('media-type', 'application/xhtml+xml')
     
-    # Update spine
-    spine_elem = root.find('.//{http://www.idpf.org/2007/opf}spine')
-    if spine_elem is None:
-        spine_elem = root.find('.//spine')
-    
+    # Update spine (element reference cached by parse_content_opf)
+    spine_elem = content_data['spine_elem']
+
     # Remove old content items from spine
     spine_items_to_remove = []
     for item in spine_elem:
         item_idref = item.get('idref')
-        # Determine if this itemref points to cover.xhtml
-        is_cover = False
-        if item_idref in content_data['manifest']:
-            is_cover = content_data['manifest'][item_idref]['href'] == 'cover.xhtml'
         # Skip nav, ncx, and cover; remove others
-        if (item_idref not in ['nav', 'ncx'] and
-            not is_cover and
-            not item_idref.startswith('ch_')):
+        if (item_idref not in _SKIP_IDS and
+            item_idref not in cover_idrefs and
+            not item_idref.startswith(_CHAPTER_ID_PREFIX)):
             spine_items_to_remove.append(item)
     
     for item in spine_items_to_remove:
@@ -358,7 +366,7 @@ def update_content_opf(content_data, chapter_files):
     # Remove any existing chapter items to avoid duplicates
     chapter_spine_items = []
     for item in spine_elem:
-        if item.get('idref') and item.get('idref').startswith('ch_'):
+        if item.get('idref') and item.get('idref').startswith(_CHAPTER_ID_PREFIX):
             chapter_spine_items.append(item)
     
     for item in chapter_spine_items:
@@ -368,12 +376,8 @@ def update_content_opf(content_data, chapter_files):
     insert_position = 0
     for i, item in enumerate(spine_elem):
         item_idref = item.get('idref')
-        if item_idref == 'nav':
+        if item_idref == 'nav' or item_idref in cover_idrefs:
             insert_position = i + 1
-        else:
-            # Check if this idref points to cover.xhtml
-            if item_idref in content_data['manifest'] and content_data['manifest'][item_idref]['href'] == 'cover.xhtml':
-                insert_position = i + 1
     
     # Insert new itemrefs at the correct position
     for i, chapter in enumerate(chapter_files):
@@ -381,26 +385,26 @@ def update_content_opf(content_data, chapter_files):
         itemref.set('idref', chapter['id'])
         spine_elem.insert(insert_position + i, itemref)
     
-    # Write updated content.opf
-    tree.write(os.path.join(content_data['opf_dir'], 'content.opf'), encoding='utf-8', xml_declaration=True)
+    # Serialize updated content.opf into the output buffer set
+    buf = io.BytesIO()
+    tree.write(buf, encoding='utf-8', xml_declaration=True)
+    new_files[posixpath.join(content_data['opf_dir'], 'content.opf')] = buf.getvalue()
 
-def update_nav_document(content_data, chapter_files):
+def update_nav_document(content_data, chapter_files, zf, new_files):
     """Update the navigation document with new chapters"""
     # Find the nav document
     nav_id = next((id for id in content_data['spine'] if id == 'nav'), None)
-    
+
     if not nav_id:
         print("Navigation document not found. Skipping nav update.")
         return
-    
+
     nav_item = content_data['manifest'].get(nav_id)
     nav_path = nav_item['full_path']
-    
-    # Parse the nav document
-    with open(nav_path, 'r', encoding='utf-8') as file:
-        nav_content = file.read()
-    
-    soup = BeautifulSoup(nav_content, 'html.parser')
+
+    # Parse the nav document straight from the zip.  The encoding hint lets
+    # bs4 hand the raw bytes to libxml2 without running its detector first.
+    soup = BeautifulSoup(zf.read(nav_path), 'lxml', from_encoding='utf-8')
     
     # Find the TOC nav element
     nav_elem = soup.find('nav', attrs={'epub:type': 'toc'})
@@ -420,7 +424,7 @@ def update_nav_document(content_data, chapter_files):
         ol.clear()
     
     # Add cover entry if present
-    cover_item = next((item for item in content_data['manifest'].values() if item['href'] == 'cover.xhtml'), None)
+    cover_item = content_data['by_href'].get('cover.xhtml')
     if cover_item:
         li = soup.new_tag('li')
         a = soup.new_tag('a', href=cover_item['href'])
@@ -436,108 +440,97 @@ def update_nav_document(content_data, chapter_files):
         li.append(a)
         ol.append(li)
     
-    # Write updated nav document
-    with open(nav_path, 'w', encoding='utf-8') as file:
-        file.write(str(soup))
+    # Serialize updated nav document straight to utf-8 bytes — no
+    # intermediate Python str and re-encode
+    new_files[nav_path] = soup.encode('utf-8')
 
-def update_ncx_document(content_data, chapter_files):
+def update_ncx_document(content_data, chapter_files, zf, new_files):
     """Update the NCX document with new chapters"""
-    # Find the NCX document
-    ncx_id = next((id for id, item in content_data['manifest'].items() if item['media-type'] == 'application/x-dtbncx+xml'), None)
-    
-    if not ncx_id:
+    # Find the NCX document (O(1) via the media-type index)
+    ncx_items = content_data['by_media_type']['application/x-dtbncx+xml']
+
+    if not ncx_items:
         print("NCX document not found. Skipping NCX update.")
         return
-    
-    ncx_item = content_data['manifest'].get(ncx_id)
-    ncx_path = ncx_item['full_path']
-    
-    # Parse the NCX document
-    tree = ET.parse(ncx_path)
-    root = tree.getroot()
-    
-    # Find the navMap element
-    ns = {'ncx': 'http://www.daisy.org/z3986/2005/ncx/'}
-    nav_map = root.find('.//ncx:navMap', ns)
-    
-    if nav_map is None:
-        nav_map = root.find('.//navMap')
-    
-    if nav_map is None:
-        print("navMap element not found. Skipping NCX update.")
-        return
-    
-    # Clear existing navPoints
-    for nav_point in list(nav_map):
-        nav_map.remove(nav_point)
-    
-    # Add new navPoints
-    play_order = 1
-    
-    # Add cover navPoint if present
-    cover_item = next((item for item in content_data['manifest'].values() if item['href'] == 'cover.xhtml'), None)
+
+    ncx_path = ncx_items[0]['full_path']
+
+    ncx_data = zf.read(ncx_path)
+
+    # The navPoint list is fully determined by the cover and chapter_files,
+    # so render the new navMap as text and splice it over the old one with a
+    # regex — the NCX never needs to be parsed at all.
+    entries = []
+    cover_item = content_data['by_href'].get('cover.xhtml')
     if cover_item:
-        nav_point = ET.SubElement(nav_map, 'navPoint')
-        nav_point.set('id', f"navPoint-{play_order}")
-        nav_point.set('playOrder', str(play_order))
-        
-        nav_label = ET.SubElement(nav_point, 'navLabel')
-        text = ET.SubElement(nav_label, 'text')
-        text.text = "Cover"
-        
-        content_elem = ET.SubElement(nav_point, 'content')
-        content_elem.set('src', cover_item['href'])
-        
-        play_order += 1
-    
-    # Add chapter entries
+        entries.append(("Cover", cover_item['href']))
     for chapter in chapter_files:
-        nav_point = ET.SubElement(nav_map, 'navPoint')
-        nav_point.set('id', f"navPoint-{play_order}")
-        nav_point.set('playOrder', str(play_order))
-        
-        nav_label = ET.SubElement(nav_point, 'navLabel')
-        text = ET.SubElement(nav_label, 'text')
-        text.text = chapter['title']
-        
-        content = ET.SubElement(nav_point, 'content')
-        content.set('src', chapter['href'])
-        
-        play_order += 1
-    
-    # Write updated NCX document
-    tree.write(ncx_path, encoding='utf-8', xml_declaration=True)
+        entries.append((chapter['title'], chapter['href']))
+
+    nav_points = []
+    for play_order, (label, src) in enumerate(entries, 1):
+        nav_points.append(
+            f'<navPoint id="navPoint-{play_order}" playOrder="{play_order}">'
+            f'<navLabel><text>{escape(label)}</text></navLabel>'
+            f'<content src={quoteattr(src)} />'
+            f'</navPoint>'
+        )
+    new_navmap = ('<navMap>' + ''.join(nav_points) + '</navMap>').encode('utf-8')
+
+    # Replacement via a callable so titles with backslashes aren't mangled
+    # by re's escape handling
+    updated, count = re.subn(rb'<navMap[^>]*>.*?</navMap>', lambda m: new_navmap,
+                             ncx_data, count=1, flags=re.S)
+
+    if count == 0:
+        print("navMap element not found. Skipping NCX update.")
+        return
+
+    new_files[ncx_path] = updated
 
-def rebuild_epub(extract_dir, output_path):
-    """Create a new EPUB file from the modified files"""
+def rebuild_epub(src, output_path, new_files, removed_files):
+    """Create a new EPUB file, stream-copying untouched entries from the source
+
+    `new_files` maps arcname -> serialized bytes for everything the rebuild
+    produced or rewrote; those are written fresh with DEFLATE compression.
+    Everything else (images, fonts, CSS, ...) is copied across with its
+    original ZipInfo, preserving compression type and timestamps.  Entries
+    listed in `removed_files` are dropped.
+    """
     print(f"Creating new EPUB at {output_path}")
-    
-    # Create a new EPUB
-    book = epub.EpubBook()
-    
-    # Copy the mimetype file first (it must be uncompressed)
-    with zipfile.ZipFile(output_path, 'w') as zip_file:
-        mimetype_path = os.path.join(extract_dir, 'mimetype')
-        if os.path.exists(mimetype_path):
-            zip_file.write(mimetype_path, 'mimetype', compress_type=zipfile.ZIP_STORED)
-    
-    # Add all files to the EPUB
-    with zipfile.ZipFile(output_path, 'a') as zip_file:
-        for root, _, files in os.walk(extract_dir):
-            for file in files:
-                if file == 'mimetype':
-                    continue  # Already added
-                
-                file_path = os.path.join(root, file)
-                arcname = os.path.relpath(file_path, extract_dir)
-                zip_file.write(file_path, arcname)
-    
-    print(f"EPUB created successfully at {output_path}")
 
-def clean_up(extract_dir):
-    """Remove temporary extraction directory"""
-    shutil.rmtree(extract_dir)
-    print(f"Removed temporary directory {extract_dir}")
+    # One pass over the source zip's central directory; no filesystem
+    # enumeration (os.walk/relpath) and no stat calls per entry.
+    entries = src.infolist()
+
+    # Deflate level 1 for the rewritten entries: they are all XHTML/XML text,
+    # where level 1 gets nearly the ratio of the default level 6 at a
+    # fraction of the CPU.  Stream-copied entries keep their own ZipInfo
+    # compress_type, so this only applies to new_files.
+    with zipfile.ZipFile(output_path, 'w',
+                         compression=zipfile.ZIP_DEFLATED, compresslevel=1) as dst:
+        # Copy the mimetype file first (it must be uncompressed)
+        mimetype_info = next((zi for zi in entries if zi.filename == 'mimetype'), None)
+        if mimetype_info is not None:
+            dst.writestr('mimetype', src.read(mimetype_info), compress_type=zipfile.ZIP_STORED)
+
+        for zi in entries:
+            name = zi.filename
+            if name == 'mimetype' or name.endswith('/'):
+                continue
+            if name in removed_files or name in new_files:
+                continue
+            # Stream through a 1MB buffer instead of slurping each asset
+            # into memory; writing against the source ZipInfo keeps the
+            # entry's compression type and timestamps.
+            with src.open(zi) as entry_src, dst.open(zi, 'w') as entry_dst:
+                shutil.copyfileobj(entry_src, entry_dst, length=1 << 20)
+
+        # Write everything the rebuild produced (OPF, nav, NCX, chapters)
+        for name, data in new_files.items():
+            dst.writestr(name, data)
+
+    print(f"EPUB created successfully at {output_path}")
 
 def main():
     # Parse command line arguments
@@ -545,42 +538,39 @@ def main():
     parser.add_argument('input_epub', help='Path to input EPUB file')
     parser.add_argument('output_epub', help='Path to output EPUB file')
     args = parser.parse_args()
-    
+
     # Set output path
     output_path = args.output_epub
-    
-    # Create a temporary directory for extraction
-    extract_dir = f"temp_epub_{uuid4().hex[:8]}"
-    
-    try:
-        # Extract the EPUB
-        extract_epub(args.input_epub, extract_dir)
-        
+
+    # Work on the EPUB zip in place -- only the OPF, nav/NCX, and spine XHTML
+    # are ever read, so the binary assets never make a disk round-trip.
+    with zipfile.ZipFile(args.input_epub, 'r') as src:
+        # Buffers for everything the rebuild produces or drops
+        new_files: dict[str, bytes] = {}
+        removed_files: set[str] = set()
+
         # Find and parse content.opf
-        content_opf_path = find_content_opf(extract_dir)
-        content_data = parse_content_opf(content_opf_path)
-        
+        opf_name = find_content_opf(src)
+        content_data = parse_content_opf(src, opf_name)
+
         # Find chapter boundaries
-        chapters = find_chapter_boundaries(content_data)
+        chapters = find_chapter_boundaries(src, content_data)
         print(f"Found {len(chapters)} chapters")
-        
+
         # Create new chapter files
-        chapter_files = create_chapter_files(chapters, content_data)
-        
+        chapter_files = create_chapter_files(chapters, content_data, src, new_files, removed_files)
+
         # Update content.opf
-        update_content_opf(content_data, chapter_files)
-        
+        update_content_opf(content_data, chapter_files, new_files)
+
         # Update navigation documents
-        update_nav_document(content_data, chapter_files)
-        update_ncx_document(content_data, chapter_files)
-        
+        update_nav_document(content_data, chapter_files, src, new_files)
+        update_ncx_document(content_data, chapter_files, src, new_files)
+
         # Create new EPUB
-        rebuild_epub(extract_dir, output_path)
-        
-        print(f"EPUB successfully rebuilt with {len(chapters)} chapters at {output_path}")
-    finally:
-        # Clean up temporary files
-        clean_up(extract_dir)
+        rebuild_epub(src, output_path, new_files, removed_files)
+
+    print(f"EPUB successfully rebuilt with {len(chapters)} chapters at {output_path}")
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file